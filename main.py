@@ -1,17 +1,37 @@
 import os
+import atexit
 import json
-import base64
+import copy
+import hashlib
 import logging
-import tempfile
+import queue
+import re
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from urllib.parse import urljoin, urlparse
+from cachetools import TTLCache
 from flask import Flask, request, jsonify
 import requests
-import pdfplumber
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import fitz
 from dotenv import load_dotenv
 from playwright.sync_api import sync_playwright, TimeoutError as PWTimeout
 import google.generativeai as genai
 from waitress import serve
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_JSON_DECODER = json.JSONDecoder()
+_STYLE_RE = re.compile(r"<style\b[^>]*>.*?</style\s*>", re.IGNORECASE | re.DOTALL)
+# Tabs separate table cells in inner_text (runs of them mark empty cells),
+# so only spaces and blank lines are collapsed.
+_BLANK_LINES_RE = re.compile(r"\n[ \n]*\n")
+_SPACES_RE = re.compile(r" {2,}")
+
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
@@ -23,44 +43,112 @@ if not GEMINI_API_KEY:
 
 genai.configure(api_key=GEMINI_API_KEY)
 
-model = genai.GenerativeModel(
-    "gemini-2.0-flash",
-    generation_config={
-        "response_mime_type": "application/json",
-        "max_output_tokens": 2000,
-    },
+GEN_CONFIG = genai.types.GenerationConfig(
+    response_mime_type="application/json",
+    max_output_tokens=1500,
 )
 
+model = genai.GenerativeModel("gemini-2.0-flash", generation_config=GEN_CONFIG)
+
 app = Flask(__name__)
 
 QUIZ_SECRET = os.environ.get("QUIZ_SECRET")
 
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=20,
+    max_retries=Retry(total=2, backoff_factor=0.3),
+)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+SESSION.headers.update({"User-Agent": "llm-analysis-quiz-solver/1.0"})
+
+MAX_CANDIDATE_DOWNLOADS = 3
+FILE_PREVIEW_CHARS = 5000
+PDF_MAX_PAGES = 30
+_DL_EXTS = frozenset({"pdf", "csv", "xlsx", "xls", "json", "zip"})
+
+BROWSER_WORKERS = 4
+RENDER_WAIT_SECONDS = 60
+
+_browser_jobs = queue.Queue()
+_browser_lock = threading.Lock()
+_browser_threads = []
+
+BLOCKED_RESOURCE_TYPES = frozenset({"image", "font", "media", "stylesheet"})
+
+_PDF_LOCK = threading.Lock()
+
+_cache_lock = threading.Lock()
+PAGE_CACHE = TTLCache(maxsize=256, ttl=300)
+SOLUTION_CACHE = TTLCache(maxsize=256, ttl=300)
+
+
+def _cache_get(cache, key):
+    with _cache_lock:
+        value = cache.get(key)
+    # Callers mutate the returned dicts (e.g. the submit payload), so hand
+    # out copies rather than the cached objects themselves.
+    return copy.deepcopy(value) if value is not None else None
+
+
+def _cache_put(cache, key, value):
+    with _cache_lock:
+        cache[key] = copy.deepcopy(value)
+
+
+def _cache_pop(cache, key):
+    with _cache_lock:
+        cache.pop(key, None)
+
+
+def _json_dumps(obj):
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(obj)
+
 
 def download_file(url, session=None, max_bytes=5_000_000):
-    s = session or requests
+    s = session or SESSION
     resp = s.get(url, stream=True, timeout=45)
-    resp.raise_for_status()
-    length = int(resp.headers.get("content-length", 0) or 0)
-    if length and length > max_bytes:
-        raise ValueError("Remote file too large")
-    data = resp.content
-    if len(data) > max_bytes:
-        raise ValueError("Downloaded file exceeds limit")
-    return data, resp.headers.get("content-type", "")
+    try:
+        resp.raise_for_status()
+        length = int(resp.headers.get("content-length", 0) or 0)
+        if length and length > max_bytes:
+            raise ValueError("Remote file too large")
+        buf = bytearray()
+        for chunk in resp.iter_content(chunk_size=65536):
+            buf.extend(chunk)
+            if len(buf) > max_bytes:
+                raise ValueError("Downloaded file exceeds limit")
+        return bytes(buf), resp.headers.get("content-type", "")
+    finally:
+        resp.close()
 
 
 def extract_text_from_pdf_bytes(pdf_bytes):
     texts = []
-    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=True) as tf:
-        tf.write(pdf_bytes)
-        tf.flush()
-        try:
-            with pdfplumber.open(tf.name) as pdf:
-                for page in pdf.pages:
-                    texts.append(page.extract_text() or "")
-        except Exception as e:
-            logging.exception("PDF parse failed: %s", e)
-            return None
+    try:
+        # PyMuPDF does not support multithreaded use, and downloads (and so
+        # PDF parsing) run on several threads at once.
+        with _PDF_LOCK:
+            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+            try:
+                for i in range(min(doc.page_count, PDF_MAX_PAGES)):
+                    texts.append(doc[i].get_text("text") or "")
+                    # Scanned PDFs yield almost no text; stop instead of
+                    # walking every image-only page.
+                    if i == 2 and sum(len(t) for t in texts) < 50:
+                        break
+            finally:
+                doc.close()
+    except Exception as e:
+        logging.exception("PDF parse failed: %s", e)
+        return None
     return "\n\n".join(texts)
 
 
@@ -108,7 +196,18 @@ def _extract_text_from_gemini_response(resp):
         return ""
 
 
-def call_gemini_for_solution(page_html, page_text, collected_files):
+def _clip(s, n):
+    # Bound by UTF-8 bytes rather than characters so the request size is
+    # predictable; errors="ignore" drops a character cut in half.
+    # n characters always take at least n bytes, so only the head is encoded.
+    head = s[:n]
+    data = head.encode("utf-8")
+    if len(data) <= n:
+        return head
+    return data[:n].decode("utf-8", errors="ignore")
+
+
+def build_gemini_prompt(page_html, page_text, collected_files):
     prompt = """
 You are an assistant that reads a rendered HTML page (provided as 'HTML' and 'TEXT') and returns a strictly valid JSON object with the following fields:
 - answer: A succinct answer value (number/string/boolean or small JSON) if known.
@@ -120,35 +219,32 @@ Rules:
 2) If you cannot determine an answer, set answer to null and include a 'reason' field.
 3) If a downloaded file is provided, process it and compute the requested answer.
 """
-    html_snippet = page_html[:14000]
-    text_snippet = page_text[:12000]
+    html_snippet = _clip(_STYLE_RE.sub("", page_html), 14000)
+    page_text = _SPACES_RE.sub(" ", _BLANK_LINES_RE.sub("\n", page_text))
+    text_snippet = _clip(page_text, 12000)
 
     files_info = []
     for f in collected_files:
         info = {"filename": f.get("filename")}
         if f.get("is_text"):
-            info["text_preview"] = (f.get("text") or "")[:5000]
+            info["text_preview"] = (f.get("text") or "")[:FILE_PREVIEW_CHARS]
         else:
-            b64 = base64.b64encode(f.get("bytes") or b"").decode("utf-8")
-            info["base64"] = b64[:10000]
+            info["sha256"] = f.get("sha256")
+            info["size"] = f.get("size")
         files_info.append(info)
 
     user_input = {"HTML": html_snippet, "TEXT": text_snippet, "FILES": files_info}
-    full_prompt = json.dumps(user_input) + "\n\n" + prompt
+    return _json_dumps(user_input) + "\n\n" + prompt
 
+
+def call_gemini_for_solution(full_prompt):
     try:
-        response = model.generate_content(
-            full_prompt, generation_config={"max_output_tokens": 1500}
-        )
+        response = model.generate_content(full_prompt)
         text_out = _extract_text_from_gemini_response(response)
         start = text_out.find("{")
-        end = text_out.rfind("}")
-        json_text = (
-            text_out[start : end + 1]
-            if start != -1 and end != -1 and end > start
-            else text_out
-        )
-        solution = json.loads(json_text)
+        if start == -1:
+            raise ValueError("No JSON object in model output")
+        solution, _ = _JSON_DECODER.raw_decode(text_out, start)
         return solution
     except Exception as e:
         logging.exception("Gemini call failed: %s", e)
@@ -161,67 +257,163 @@ Rules:
         }
 
 
-def render_page_and_collect(url, timeout_ms=30000):
-    collected_files = []
-    html = ""
-    visible_text = ""
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context()
-        page = context.new_page()
+def _safe_download(url):
+    try:
+        data, content_type = download_file(url, SESSION)
+    except Exception as e:
+        logging.warning("Failed to download candidate %s : %s", url, e)
+        return None
+    path = urlparse(url).path.lower()
+    filename = os.path.basename(path) or "downloaded"
+    # Only what the prompt needs is kept; raw bytes would otherwise sit in
+    # PAGE_CACHE for every cached URL.
+    file_entry = {"filename": filename}
+    if (
+        content_type.startswith("text/")
+        or filename.endswith(".csv")
+        or filename.endswith(".json")
+    ):
         try:
-            page.goto(url, wait_until="networkidle", timeout=timeout_ms)
-        except PWTimeout:
+            # UTF-8 is at most 4 bytes per character, so this prefix always
+            # covers the preview.
+            prefix = data[: FILE_PREVIEW_CHARS * 4]
+            file_entry["text"] = prefix.decode("utf-8", errors="ignore")[
+                :FILE_PREVIEW_CHARS
+            ]
+            file_entry["is_text"] = True
+        except Exception:
+            file_entry["is_text"] = False
+    elif filename.endswith(".pdf"):
+        file_entry["text"] = (extract_text_from_pdf_bytes(data) or "")[
+            :FILE_PREVIEW_CHARS
+        ]
+        file_entry["is_text"] = True
+    else:
+        file_entry["is_text"] = False
+    if not file_entry["is_text"]:
+        # Binary files are described to the model by hash and size only.
+        file_entry["sha256"] = hashlib.sha256(data).hexdigest()[:16]
+        file_entry["size"] = len(data)
+    return file_entry
+
+
+def _browser_worker():
+    # Playwright's sync API is bound to the thread that started it, so each
+    # worker thread owns its own browser and runs jobs from the shared queue.
+    pw = None
+    browser = None
+    try:
+        while True:
+            job = _browser_jobs.get()
+            if job is None:
+                break
+            fn, args, future = job
+            if not future.set_running_or_notify_cancel():
+                continue
             try:
-                page.goto(url, wait_until="load", timeout=timeout_ms)
+                if pw is None:
+                    pw = sync_playwright().start()
+                if browser is None or not browser.is_connected():
+                    browser = pw.chromium.launch(headless=True)
+                future.set_result(fn(browser, *args))
             except Exception as e:
-                logging.warning("Playwright navigation warning: %s", e)
+                future.set_exception(e)
+    finally:
+        if browser is not None:
+            try:
+                browser.close()
+            except Exception:
+                pass
+        if pw is not None:
+            pw.stop()
+
+
+def _run_in_browser(fn, *args, timeout=None):
+    with _browser_lock:
+        if not _browser_threads:
+            for i in range(BROWSER_WORKERS):
+                t = threading.Thread(
+                    target=_browser_worker, name=f"playwright-{i}", daemon=True
+                )
+                t.start()
+                _browser_threads.append(t)
+    future = Future()
+    _browser_jobs.put((fn, args, future))
+    try:
+        return future.result(timeout=timeout)
+    finally:
+        # Drop the job if it is still queued; a running render is left to
+        # hit its own Playwright timeouts.
+        future.cancel()
+
+
+def _close_browser():
+    alive = [t for t in _browser_threads if t.is_alive()]
+    for _ in alive:
+        _browser_jobs.put(None)
+    for t in alive:
+        t.join(timeout=10)
+
+
+atexit.register(_close_browser)
+
+
+def _block_heavy_resources(route):
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        route.abort()
+    else:
+        route.continue_()
+
+
+def _render_page(browser, url, timeout_ms):
+    candidates = []
+    context = browser.new_context(
+        java_script_enabled=True,
+        viewport={"width": 1024, "height": 768},
+        locale="en-US",
+    )
+    try:
+        context.route("**/*", _block_heavy_resources)
+        page = context.new_page()
+        try:
+            page.goto(url, wait_until="domcontentloaded", timeout=timeout_ms)
+        except Exception as e:
+            logging.warning("Playwright navigation warning: %s", e)
+        try:
+            page.wait_for_selector("a[href], form", timeout=5000)
+        except PWTimeout:
+            pass
         html = page.content()
         visible_text = page.inner_text("body") if page.query_selector("body") else ""
-        anchors = page.query_selector_all("a")
-        for a in anchors:
-            try:
-                href = a.get_attribute("href")
-                if not href:
-                    continue
-                full = urljoin(url, href)
-                parsed = urlparse(full)
-                path = parsed.path.lower()
-                if any(
-                    path.endswith(ext)
-                    for ext in [".pdf", ".csv", ".xlsx", ".xls", ".json", ".zip"]
-                ):
-                    try:
-                        data, content_type = download_file(full)
-                        filename = os.path.basename(path) or "downloaded"
-                        file_entry = {"filename": filename, "bytes": data}
-                        if (
-                            content_type.startswith("text/")
-                            or filename.endswith(".csv")
-                            or filename.endswith(".json")
-                        ):
-                            try:
-                                file_entry["text"] = data.decode(
-                                    "utf-8", errors="ignore"
-                                )
-                                file_entry["is_text"] = True
-                            except Exception:
-                                file_entry["is_text"] = False
-                        elif filename.endswith(".pdf"):
-                            file_entry["text"] = extract_text_from_pdf_bytes(data) or ""
-                            file_entry["is_text"] = True
-                        else:
-                            file_entry["is_text"] = False
-                        collected_files.append(file_entry)
-                        break
-                    except Exception as e:
-                        logging.warning("Failed to download candidate %s : %s", full, e)
-                        continue
-            except Exception as e:
-                logging.warning("Error processing anchor: %s", e)
-                continue
+        hrefs = page.eval_on_selector_all(
+            "a[href]", "els => els.map(e => e.getAttribute('href'))"
+        )
+    finally:
         context.close()
-        browser.close()
+    for href in hrefs:
+        if not href:
+            continue
+        full = urljoin(url, href)
+        suffix = urlparse(full).path.rsplit(".", 1)[-1].lower()
+        if suffix in _DL_EXTS and full not in candidates:
+            candidates.append(full)
+    return html, visible_text, candidates
+
+
+def render_page_and_collect(url, timeout_ms=30000):
+    collected_files = []
+    html, visible_text, candidates = _run_in_browser(
+        _render_page,
+        url,
+        timeout_ms,
+        timeout=timeout_ms / 1000 + RENDER_WAIT_SECONDS,
+    )
+    candidates = candidates[:MAX_CANDIDATE_DOWNLOADS]
+    if candidates:
+        with ThreadPoolExecutor(max_workers=len(candidates)) as ex:
+            for file_entry in ex.map(_safe_download, candidates):
+                if file_entry is not None:
+                    collected_files.append(file_entry)
     return {"html": html, "text": visible_text, "collected_files": collected_files}
 
 
@@ -241,13 +433,33 @@ def quiz_endpoint():
     if not url or not email:
         return jsonify({"error": "missing_fields"}), 400
     try:
-        page_data = render_page_and_collect(url)
+        page_data = _cache_get(PAGE_CACHE, url)
+        fresh_page = page_data is None
+        if fresh_page:
+            page_data = render_page_and_collect(url)
+            logging.info(
+                "Rendered %s: html=%d chars, files=%d",
+                url,
+                len(page_data["html"]),
+                len(page_data["collected_files"]),
+            )
+            if len(page_data["text"].strip()) < 20 and not page_data["collected_files"]:
+                return jsonify({"error": "empty_page"}), 502
         html = page_data["html"]
         text = page_data["text"]
         files = page_data["collected_files"]
-        solution = call_gemini_for_solution(html, text, files)
+        full_prompt = build_gemini_prompt(html, text, files)
+        cache_key = hashlib.blake2b(
+            full_prompt.encode("utf-8"), digest_size=16
+        ).hexdigest()
+        solution = _cache_get(SOLUTION_CACHE, cache_key)
+        from_cache = solution is not None
+        if not from_cache:
+            solution = call_gemini_for_solution(full_prompt)
         if not isinstance(solution, dict):
             return jsonify({"error": "model_failed"}), 500
+        # Snapshot before the payload is filled in with the caller's secret.
+        fresh_solution = None if from_cache else copy.deepcopy(solution)
         payload = solution.get("payload")
         submit_url = solution.get("submit_url")
         if payload is None and solution.get("answer") is not None and submit_url:
@@ -266,11 +478,25 @@ def quiz_endpoint():
         attach_b64 = solution.get("attachment_base64")
         if attach_b64:
             payload["attachment_base64"] = attach_b64
-        resp = requests.post(submit_url, json=payload, headers=headers, timeout=90)
+        resp = SESSION.post(submit_url, json=payload, headers=headers, timeout=90)
         try:
             resp_json = resp.json()
         except Exception:
             resp_json = {"status_code": resp.status_code, "text": resp.text}
+        # Gemini is not deterministic and a render may miss late JS content,
+        # so only remember pages and answers the quiz server accepted; a
+        # retry after a rejection renders and asks the model again.
+        accepted = resp.ok and not (
+            isinstance(resp_json, dict) and resp_json.get("correct") is False
+        )
+        if accepted:
+            if fresh_page:
+                _cache_put(PAGE_CACHE, url, page_data)
+            if fresh_solution is not None:
+                _cache_put(SOLUTION_CACHE, cache_key, fresh_solution)
+        else:
+            _cache_pop(PAGE_CACHE, url)
+            _cache_pop(SOLUTION_CACHE, cache_key)
         return (
             jsonify(
                 {
@@ -289,5 +515,5 @@ def quiz_endpoint():
 
 if __name__ == "__main__":
     #app.run(port=5000, debug=True)
-    serve(app, host="0.0.0.0", port=8000)
+    serve(app, host="0.0.0.0", port=8000, threads=16, connection_limit=200)
 